@@ -1,10 +1,14 @@
 from abc import ABC, abstractmethod
+import atexit
 import os
+import queue
 import shutil
+import threading
+import traceback
 from abc import abstractmethod
 from itertools import chain
 from collections import defaultdict, deque
-from functools import partial
+from functools import cached_property
 
 import numpy as np
 from tensorboardX import SummaryWriter
@@ -14,6 +18,37 @@ import torch.optim as optim
 from ..memories import ACMemory
 
 
+_DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def _compute_gae(deltas, masks, decay_rate):
+    """Calculate advantage from deltas with the backward recursion
+    A_t = delta_t + decay_rate * mask_t * A_{t+1}
+
+    Parameters
+    ----------
+    deltas: torch.Tensor, shape (T, n_workers)
+        TD errors
+    masks: torch.Tensor, shape (T, n_workers)
+        0 if the episode terminated at the step, otherwise 1
+    decay_rate: float or torch.Tensor
+        The product of discount and GAE lambda. A tensor broadcastable
+        to masks gives per-step rates
+
+    Returns
+    -------
+    torch.Tensor of advantages with the same shape as deltas
+    """
+    # Decay factors of all steps in one op rather than one per step
+    decays = decay_rate * masks
+    advs = []
+    adv = torch.zeros_like(deltas[0])
+    for t in reversed(range(deltas.size(0))):
+        adv = deltas[t] + decays[t] * adv
+        advs.append(adv)
+    return torch.stack(advs[::-1])
+
+
 class BaseAgent(ABC):
     """Abstract class for Agent
 
@@ -31,22 +66,65 @@ class BaseAgent(ABC):
         The length to smooth data before recording
     log_dir: str
         Directory to store the recrod for tensorboard
+    reset_logdir: bool
+        If True, delete old logs in log_dir
     """
     def __init__(self, state_shape, action_config, processor=None, reward_reshape=None,
-                 smooth_length=100, log_dir='./logs'):
+                 smooth_length=100, log_dir='./logs', reset_logdir=False):
         super(BaseAgent, self).__init__()
         self.state_shape = state_shape
         self.action_config = action_config
         self.processor = processor
         self.reward_reshape = reward_reshape
         self.smooth_length = smooth_length
+        self.log_dir = log_dir
         # Delete old logs if any
-        if os.path.isdir(log_dir):
+        if reset_logdir and os.path.isdir(log_dir):
             print('Delete old tensorboard log')
             shutil.rmtree(log_dir)
-        self.writer = SummaryWriter(log_dir)
         self.record_step = 0
         self.episode_step = 0
+        # Write records in background not to block training
+        self._log_queue = queue.Queue()
+        self._log_thread = None
+
+    @cached_property
+    def writer(self):
+        # Create at the first write so that agents without logs make no file
+        return SummaryWriter(self.log_dir)
+
+    def _write_logs(self):
+        while True:
+            method, args, kwargs = self._log_queue.get()
+            try:
+                getattr(self.writer, method)(*args, **kwargs)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._log_queue.task_done()
+
+    def _log(self, method, *args, **kwargs):
+        """Queue a call of SummaryWriter method, e.g., 'add_scalar'"""
+        if self._log_thread is None:
+            self._log_thread = threading.Thread(target=self._write_logs,
+                                                daemon=True)
+            self._log_thread.start()
+            # The daemon thread is killed at exit, so write out what is
+            # left then, e.g., when the agent is driven without Runner
+            atexit.register(self.close_log)
+        self._log_queue.put((method, args, kwargs))
+
+    def flush_log(self):
+        """Block until all queued records are written"""
+        self._log_queue.join()
+        if 'writer' in self.__dict__:
+            self.writer.flush()
+
+    def close_log(self):
+        """Write all queued records and close the writer"""
+        self.flush_log()
+        if 'writer' in self.__dict__:
+            self.writer.close()
 
     @abstractmethod
     def predict(self, *args, **kwrags):
@@ -79,6 +157,8 @@ class ACAgent(BaseAgent):
         The length to smooth data before recording
     log_dir: str
         Directory to store the recrod for tensorboard
+    reset_logdir: bool
+        If True, delete old logs in log_dir
     window_length: int
     lr: float
     critic_config: dict
@@ -94,6 +174,12 @@ class ACAgent(BaseAgent):
     entropy_coef: float
     value_loss_coef: float
     max_grad_nrom: float
+    use_torch_compile: bool
+        If True, compile the model and the advantage calculation
+        with torch.compile
+    allow_tf32: bool
+        If True, allow TF32 for float32 matmuls on CUDA. This changes
+        the global torch setting
     """
 
     def __init__(self, state_shape, action_config, processor,
@@ -101,10 +187,12 @@ class ACAgent(BaseAgent):
                  window_length, lr, model_config,
                  action_dist, discount, gae_lambda, num_frames_per_proc,
                  batch_size,
-                 entropy_coef, value_loss_coef, max_grad_norm):
+                 entropy_coef, value_loss_coef, max_grad_norm,
+                 use_torch_compile=False, reset_logdir=False,
+                 allow_tf32=False):
         super(ACAgent, self).__init__(state_shape, action_config, processor,
                                       reward_reshape,
-                                      smooth_length, log_dir)
+                                      smooth_length, log_dir, reset_logdir)
         self.widow_length = window_length
         self.action_dist = action_dist
         self.discount = discount
@@ -119,21 +207,44 @@ class ACAgent(BaseAgent):
         # Build Network
         self.ac_model = self.build_model(model_config)
         # Build optimizer
-        self.parameters = self.ac_model.parameters()
-        self.optimizer = optim.Adam(self.parameters, lr=lr)
+        self.optimizer = optim.Adam(self.ac_model.parameters(), lr=lr)
         # Set device
-        self.device = torch.device(
-            'cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = _DEVICE
+        self.ac_model.to(self.device)
+        if allow_tf32 and self.device.type == 'cuda':
+            # Process-wide setting, so only changed when asked for
+            torch.backends.cuda.matmul.allow_tf32 = True
+        # Run the forward in bfloat16 on Ampere or newer, where it has native
+        # support; parameters stay float32
+        self.use_amp = (self.device.type == 'cuda'
+                        and torch.cuda.get_device_capability(self.device)[0] >= 8)
+        # Compile after moving to device; 'reduce-overhead' is not used since
+        # CUDA graphs overwrite outputs, and values are kept across steps
+        self.use_torch_compile = use_torch_compile
+        if use_torch_compile:
+            self.ac_model = torch.compile(self.ac_model, dynamic=False)
+            self._compute_gae = torch.compile(_compute_gae, dynamic=False)
+        else:
+            self._compute_gae = _compute_gae
+        # Page-locked staging buffers for asynchronous host to device copy
+        self._pinned_buffers = dict()
+        self._pinned_events = dict()
         # Record parameters
         self.episode_steps = defaultdict(lambda: 0)
-        mydeque = partial(deque, maxlen=self.smooth_length)
-        self.reward_record = defaultdict(mydeque)
+        # Last smooth_length rewards of each worker as a ring buffer
+        self._reward_ring = None
+        self._ring_ptr = 0
         self.loss_record = deque(maxlen=self.smooth_length)
         self.actor_loss_record = deque(maxlen=self.smooth_length)
         self.critic_loss_record = deque(maxlen=self.smooth_length)
         self.entropy_record = deque(maxlen=self.smooth_length)
-        self.ep_rewards = defaultdict(list)
-        self.ep_actions = defaultdict(list)
+        # Episode records of shape (n_workers, capacity, ...), allocated
+        # at the first record and doubled when an episode outgrows them
+        self._ep_capacity = 1024
+        self._ep_rewards = None
+        self._ep_actions = None
+        self._ep_idx = None
+        self._ep_reward_sum = None
 
     @abstractmethod
     def build_model(self, config):
@@ -144,105 +255,196 @@ class ACAgent(BaseAgent):
         x = model(x)
         return x.size(-1)
 
-    def predict(self, obs, training=True):
+    def _to_device(self, key, data, dtype=torch.float):
+        """Transfer array-like data to the device as a tensor of dtype
+
+        On GPU, data is staged in a pinned buffer reused across calls under
+        the same key so that the copy can run with non_blocking=True.
+        Casting to dtype is done while filling the buffer.
+        """
+        data = np.asarray(data)
+        if self.device.type != 'cuda':
+            return torch.from_numpy(data).to(dtype)
+        # Wait until the previous copy from the buffer has finished
+        event = self._pinned_events.get(key)
+        if event is None:
+            event = torch.cuda.Event()
+            self._pinned_events[key] = event
+        else:
+            event.synchronize()
+        buf = self._pinned_buffers.get(key)
+        if (buf is None or tuple(buf.shape) != data.shape
+                or buf.dtype != dtype):
+            buf = torch.empty(data.shape, dtype=dtype, pin_memory=True)
+            self._pinned_buffers[key] = buf
+        np.copyto(buf.numpy(), data)
+        tensor = buf.to(self.device, non_blocking=True)
+        event.record()
+        return tensor
+
+    def _to_numpy(self, key, tensor):
+        """Transfer tensor to host as a numpy array
+
+        On GPU, the copy goes to a pinned buffer reused across calls under
+        the same key, so the returned array is overwritten by the next call.
+        """
+        if self.device.type != 'cuda':
+            return tensor.numpy()
+        buf = self._pinned_buffers.get(key)
+        if buf is None or buf.shape != tensor.shape or buf.dtype != tensor.dtype:
+            buf = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+            self._pinned_buffers[key] = buf
+        buf.copy_(tensor, non_blocking=True)
+        torch.cuda.current_stream().synchronize()
+        return buf.numpy()
+
+    def _process(self, obs):
         if self.processor is not None:
-            obs = [self.processor.process(obs_i) for obs_i in obs]
+            obs = self.processor.process_batch(np.stack(obs, axis=0))
+        return obs
+
+    def _forward(self, state_tensor):
+        with torch.autocast(self.device.type, dtype=torch.bfloat16,
+                            enabled=self.use_amp):
+            dist, value = self.ac_model(state_tensor)
+        # Keep value in float32 for the advantage calculation
+        return dist, value.float()
+
+    def predict(self, obs, training=True):
+        """Select actions of workers
+
+        The returned array is reused by the next call on GPU; keep a copy
+        if it is needed after that.
+        """
+        obs = self._process(obs)
         state = self.memory.get_recent_state(obs)
-        state_tensor = torch.tensor(state, dtype=torch.float,
-                                    device=self.device)
-        dist, value = self.ac_model(state_tensor)
-        action = dist.sample()
-        if training:
+        state_tensor = self._to_device('state', state)
+        if not training:
+            with torch.inference_mode():
+                dist, value = self._forward(state_tensor)
+                action = dist.sample()
+            return self._to_numpy('action', action)
+        # Rollout data are constants for the update, which evaluates
+        # the policy on the stored states again
+        with torch.no_grad():
+            dist, value = self._forward(state_tensor)
+            action = dist.sample()
             log_prob = dist.log_prob(action)
-            entropy = dist.entropy()
-            self.memory.store_value_log_prob(value, log_prob, entropy)
-        return action.cpu().numpy()
+        self.memory.store_value_log_prob(value, log_prob, state_tensor)
+        return self._to_numpy('action', action)
 
     def observe(self, obs, action, reward, terminal, info, training=True):
-        obs = [self.processor.process(obs_i) for obs_i in obs]
+        obs = self._process(obs)
         self.memory.append(obs, action, reward, terminal, training)
         self.record(action, reward, terminal)
 
+    def _init_episode_records(self, action):
+        n_workers = len(action)
+        action_shape = np.shape(action)[1:]
+        self._ep_rewards = np.zeros((n_workers, self._ep_capacity),
+                                    dtype=np.float32)
+        self._ep_actions = np.zeros((n_workers, self._ep_capacity) + action_shape,
+                                    dtype=np.float32)
+        self._ep_idx = np.zeros(n_workers, dtype=np.int64)
+        self._ep_reward_sum = np.zeros(n_workers)
+        self._reward_ring = np.zeros((n_workers, self.smooth_length),
+                                     dtype=np.float32)
+
+    def _grow_episode_records(self):
+        pad = self._ep_capacity
+        self._ep_capacity *= 2
+        self._ep_rewards = np.pad(self._ep_rewards, [(0, 0), (0, pad)])
+        pad_width = [(0, 0), (0, pad)] + [(0, 0)] * (self._ep_actions.ndim - 2)
+        self._ep_actions = np.pad(self._ep_actions, pad_width)
+
     def record(self, action, reward, terminal):
         n_workers = len(action)
-        for i in range(n_workers):
-            self.reward_record[i].append(reward[i])
-            self.ep_rewards[i].append(reward[i])
-            self.ep_actions[i].append(action[i])
-            if terminal[i]:
-                ep_sum_reward = np.sum(self.ep_rewards[i])
-                self.writer.add_scalar(f'data/episode_reward_sum_{i}',
-                                       ep_sum_reward,
-                                       self.episode_steps[i])
-
-                self.writer.add_histogram(f'data/episode_action_{i}',
-                                          np.array(self.ep_actions[i]),
-                                          self.episode_steps[i], bins='auto')
-
-                self.writer.add_histogram(f'data/episode_reward_dist_{i}',
-                                          np.array(self.ep_rewards[i]),
-                                          self.episode_steps[i], bins='auto')
-
-                # Reset record
-                self.episode_steps[i] += 1
-                self.ep_rewards[i] = []
-                self.ep_actions[i] = []
+        if self._ep_idx is None:
+            self._init_episode_records(action)
+        if self._ep_idx.max() >= self._ep_capacity:
+            self._grow_episode_records()
+        workers = np.arange(n_workers)
+        self._ep_rewards[workers, self._ep_idx] = reward
+        self._ep_actions[workers, self._ep_idx] = action
+        self._ep_idx += 1
+        self._ep_reward_sum += reward
+        # All workers record every step, so they share one pointer
+        self._reward_ring[:, self._ring_ptr % self.smooth_length] = reward
+        self._ring_ptr += 1
+        for i in np.flatnonzero(terminal).tolist():
+            ep_length = self._ep_idx[i]
+            ep_rewards = self._ep_rewards[i, :ep_length]
+            self._log('add_scalar', f'data/episode_reward_sum_{i}',
+                      self._ep_reward_sum[i], self.episode_steps[i])
+
+            # Copy since the buffers are overwritten by the next episode
+            self._log('add_histogram', f'data/episode_action_{i}',
+                      self._ep_actions[i, :ep_length].copy(),
+                      self.episode_steps[i], bins=64)
+
+            self._log('add_histogram', f'data/episode_reward_dist_{i}',
+                      ep_rewards.copy(),
+                      self.episode_steps[i], bins=64)
+
+            # Reset record
+            self.episode_steps[i] += 1
+            self._ep_idx[i] = 0
+            self._ep_reward_sum[i] = 0.
         self.record_step += 1
 
+    def smoothed_rewards(self):
+        """Return mean of the last smooth_length rewards of each worker
+
+        Returns
+        -------
+        np.ndarray of shape (n_workers,)
+        """
+        if self._reward_ring is None:
+            return np.zeros(0)
+        n_filled = min(self._ring_ptr, self.smooth_length)
+        return self._reward_ring[:, :n_filled].mean(axis=1)
+
     def set_new_obs(self, new_obs):
-        if self.processor is not None:
-            new_obs = [self.processor.process(obs_i) for obs_i in new_obs]
-        self.new_obs = new_obs
+        self.new_obs = self._process(new_obs)
 
     def get_newest_state(self):
         return self.memory.get_recent_state(self.new_obs)
 
+    @torch.no_grad()
     def aggregate_experiences(self):
+        """Return rollout data for the update, all without gradients
+
+        Returns
+        -------
+        Tuple of states, actions, log probabilities of the actions,
+        advantages and returns, each with leading axes (T, n_workers)
+        """
         experiences = self.memory.sample()
-        rewards = torch.tensor(np.array(experiences.reward),
-                               dtype=torch.float,
-                               device=self.device)
-        masks = torch.tensor(1. - np.array(experiences.terminal, dtype=float),
-                             device=self.device,
-                             dtype=torch.float)
-        values = torch.tensor(torch.stack(experiences.value),
-                              dtype=torch.float,
-                              device=self.device)
-        values = torch.sum(values, -1)
-        log_probs = torch.tensor(torch.stack(experiences.log_prob),
-                                 dtype=torch.float,
-                                 device=self.device)
-
-        entropies = torch.tensor(torch.stack(experiences.entropy),
-                                 dtype=torch.float,
-                                 device=self.device)
-
-        T = len(rewards)
-        # Get delta
-        deltas = []
-        for t in range(T - 1):
-            target = (rewards[t] + values[t + 1] * masks[t]).detach()
-            delta = target - values[t]
-            deltas.append(delta)
-        # Estaimte with the newest value
-        new_state = torch.tensor(self.get_newest_state(),
-                                 dtype=torch.float,
-                                 device=self.device)
-        new_value = self.ac_model(new_state)[1].sum(-1)
-        new_target = (rewards[-1] + new_value * masks[-1]).detach()
-        new_delta = new_target - values[-1]
-        deltas.append(new_delta)
+        rewards = self._to_device('reward', experiences.reward)
+        masks = 1. - self._to_device('terminal', experiences.terminal)
+        # Discrete actions index the distribution, so keep them integer
+        if np.issubdtype(experiences.action.dtype, np.integer):
+            action_dtype = torch.long
+        else:
+            action_dtype = torch.float
+        actions = self._to_device('rollout_action', experiences.action,
+                                  dtype=action_dtype)
+        # Views of the memory, already on the device
+        states = experiences.state
+        values = experiences.value
+        log_probs = experiences.log_prob
+
+        # Estaimte the last step with the newest value
+        new_state = self._to_device('new_state', self.get_newest_state())
+        new_value = self._forward(new_state)[1]
+        next_values = torch.cat([values[1:], new_value.unsqueeze(0)])
+        # Get delta of all steps at once
+        targets = rewards + next_values * masks
+        deltas = targets - values
 
         # Calculate advantage from deltas
         decay_rate = self.discount * self.gae_lambda
-        advs = []
-        for t_st in range(T):
-            adv = 0.
-            power = 0.
-            for t in range(t_st, T):
-                adv += deltas[t] * (decay_rate ** power)
-                power += 1.
-            advs.append(adv)
-        advs = torch.stack(advs)
+        advs = self._compute_gae(deltas, masks, decay_rate)
+        returns = advs + values
         self.memory.reset()
-        return advs, log_probs, entropies
\ No newline at end of file
+        return states, actions, log_probs, advs, returns
\ No newline at end of file
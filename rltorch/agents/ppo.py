@@ -14,6 +14,12 @@ class PPOAgent(ACAgent):
         The number of steps to fit models after collecting data
     clip_eps: float
         Clip parameter for loss function
+    use_torch_compile: bool
+        If True, compile the model and the advantage calculation
+    reset_logdir: bool
+        If True, delete old logs in log_dir
+    allow_tf32: bool
+        If True, allow TF32 for float32 matmuls on CUDA globally
     """
     def __init__(self, state_shape, action_config, processor=None,
                  reward_reshape=None, smooth_length=100, log_dir='./logs',
@@ -21,7 +27,9 @@ class PPOAgent(ACAgent):
                  action_dist=dist.Categorical, discount=0.99, gae_lambda=0.95,
                  num_frames_per_proc=32, batch_size=32, entropy_coef=0.01,
                  value_loss_coef=0.2,
-                 max_grad_norm=None, clip_eps=0.2, n_epochs=4):
+                 max_grad_norm=None, clip_eps=0.2, n_epochs=4,
+                 use_torch_compile=False, reset_logdir=False,
+                 allow_tf32=False):
 
         super(PPOAgent, self).__init__(state_shape, action_config, processor,
                                        reward_reshape, smooth_length, log_dir,
@@ -30,63 +38,66 @@ class PPOAgent(ACAgent):
                                        gae_lambda, num_frames_per_proc,
                                        batch_size,
                                        entropy_coef, value_loss_coef,
-                                       max_grad_norm)
+                                       max_grad_norm, use_torch_compile,
+                                       reset_logdir, allow_tf32)
         self.clip_eps = clip_eps
         self.n_epochs = n_epochs
 
     def fit(self, *args, **kwargs):
         if self.memory.nb_states < self.num_frames_per_proc:
             return
-        advs, log_probs, entropies = self.aggregate_experiences()
+        states, actions, old_log_probs, advs, returns = \
+            self.aggregate_experiences()
         T = advs.size(0)
         for epoch in range(self.n_epochs):
             for idx in range(T // self.batch_size):
                 t_st = idx * self.batch_size
                 t_end = (idx + 1) * self.batch_size
-                batch_advs = advs[t_st:t_end].view(-1)
-                batch_log_probs = log_probs[t_st:t_end].view(-1)
-                batch_entropies = entropies[t_st:t_end].view(-1)
+                # Evaluate the current policy on the rollout states
+                batch_states = states[t_st:t_end].flatten(0, 1)
+                policy, batch_values = self._forward(batch_states)
+                batch_actions = actions[t_st:t_end].flatten(0, 1)
+                batch_log_probs = policy.log_prob(batch_actions)
+                batch_old_log_probs = old_log_probs[t_st:t_end].reshape(-1)
+                batch_advs = advs[t_st:t_end].reshape(-1)
+                batch_returns = returns[t_st:t_end].reshape(-1)
                 # Actor Training
-                old_log_probs = batch_log_probs.detach()
-                ratio = torch.exp(batch_log_probs - old_log_probs)
-                # Use advantage as constanats when optimizing the policy
-                advs_const = batch_advs.detach()
-                surr1 = ratio * advs_const
+                ratio = torch.exp(batch_log_probs - batch_old_log_probs)
+                surr1 = ratio * batch_advs
                 surr2 = torch.clamp(ratio, 1.0 - self.clip_eps,
-                                    1.0 + self.clip_eps) * advs_const
+                                    1.0 + self.clip_eps) * batch_advs
                 actor_loss = -torch.min(surr1, surr2).mean()
                 # Critic Training
-                batch_critic_loss = (batch_advs ** 2).mean()
+                batch_critic_loss = ((batch_returns - batch_values) ** 2).mean()
                 # Entropy regularization
-                batch_entropy = batch_entropies.mean()
+                batch_entropy = policy.entropy().mean()
                 # Total Loss
                 loss = actor_loss \
                         + self.value_loss_coef * batch_critic_loss \
                         - self.entropy_coef * batch_entropy
                 # Optimizer Model
                 self.optimizer.zero_grad()
-                # Need to keep intermediate results for multiple loops
-                loss.backward(retain_graph=True)
+                loss.backward()
                 # Clip Gradient
                 if self.max_grad_norm is not None:
-                    nn.utils.clip_grad_norm(self.parameters, self.max_grad_norm)
+                    nn.utils.clip_grad_norm_(self.ac_model.parameters(),
+                                             self.max_grad_norm)
                 self.optimizer.step()
                 self.loss_record.append(loss.item())
                 self.actor_loss_record.append(actor_loss.item())
                 self.critic_loss_record.append(batch_critic_loss.item())
                 self.entropy_record.append(batch_entropy.item())
-        self.writer.add_scalar(f'data/loss', np.mean(self.loss_record),
-                               self.record_step)
-        self.writer.add_scalar(f'data/actor_loss', np.mean(self.actor_loss_record),
-                               self.record_step)
-        self.writer.add_scalar(f'data/critic_loss', np.mean(self.critic_loss_record),
-                               self.record_step)
-        self.writer.add_scalar(f'data/entropy', np.mean(self.entropy_record),
-                               self.record_step)
-        for key in self.reward_record.keys():
-            self.writer.add_scalar(f'data/reward_{key}',
-                                   np.mean(self.reward_record[key]),
-                                   self.record_step)
+        self._log('add_scalar', f'data/loss', np.mean(self.loss_record),
+                  self.record_step)
+        self._log('add_scalar', f'data/actor_loss',
+                  np.mean(self.actor_loss_record), self.record_step)
+        self._log('add_scalar', f'data/critic_loss',
+                  np.mean(self.critic_loss_record), self.record_step)
+        self._log('add_scalar', f'data/entropy', np.mean(self.entropy_record),
+                  self.record_step)
+        for key, reward in enumerate(self.smoothed_rewards()):
+            self._log('add_scalar', f'data/reward_{key}', reward,
+                      self.record_step)
 
     def build_model(self, config=None):
         # Share layer
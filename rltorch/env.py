@@ -1,9 +1,40 @@
 
 from multiprocessing import Process, Pipe
+from multiprocessing.sharedctypes import RawArray
 import gym
+import numpy as np
 
 
-def worker(conn, env):
+def make_shared_obs(observation_space):
+    """Allocate shared memory to pass an observation between processes
+
+    Parameters
+    ----------
+    observation_space: gym.Space
+
+    Returns
+    -------
+    Tuple of (RawArray, dtype, shape) or None if the space has no
+    fixed shape, e.g., Tuple or Dict spaces
+    """
+    shape = getattr(observation_space, 'shape', None)
+    dtype = getattr(observation_space, 'dtype', None)
+    if not shape or dtype is None:
+        return None
+    dtype = np.dtype(dtype)
+    raw = RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+    return raw, dtype.str, shape
+
+
+def as_array(shared_obs):
+    """Return numpy view of shared memory made by make_shared_obs"""
+    if shared_obs is None:
+        return None
+    raw, dtype, shape = shared_obs
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+def worker(conn, env, shared_obs=None):
     """Execute cmd sent from remote process
 
     Parameters
@@ -11,7 +42,22 @@ def worker(conn, env):
     conn: multiprocess.Connection instance
         Supposed to recieve command and data from remote process
     env: gym.Env instance
+    shared_obs: tuple, optional
+        Shared memory made by make_shared_obs. If given, observations
+        matching its shape and dtype are written there and None is sent
+        in place of them
     """
+    obs_buf = as_array(shared_obs)
+
+    def pack(obs):
+        # Fall back to the pipe if obs does not match the declared space,
+        # which would otherwise be cast silently or fail to be written
+        if (obs_buf is None or not isinstance(obs, np.ndarray)
+                or obs.shape != obs_buf.shape or obs.dtype != obs_buf.dtype):
+            return obs
+        obs_buf[...] = obs
+        return None
+
     try:
         while True:
             cmd, data = conn.recv()
@@ -19,10 +65,10 @@ def worker(conn, env):
                 obs, reward, done, info = env.step(data)
                 if done:
                     obs = env.reset()
-                conn.send((obs, reward, done, info))
+                conn.send((pack(obs), reward, done, info))
             elif cmd == 'reset':
                 obs = env.reset()
-                conn.send(obs)
+                conn.send(pack(obs))
             elif cmd == 'render':
                 env.render()
             elif cmd == 'close':
@@ -44,9 +90,12 @@ class ParallelEnv(gym.Env):
     ----------
     envs: list(gym.Env)
         The list of the same gym environment
+    shared_memory: bool
+        If True, remote workers return observations through shared memory
+        instead of pickling them through pipes
     """
 
-    def __init__(self, envs):
+    def __init__(self, envs, shared_memory=True):
         assert len(envs) >= 1, 'No environment given'
 
         self.envs = envs
@@ -55,18 +104,31 @@ class ParallelEnv(gym.Env):
 
         # Only index 0 environment runs as a non-daemon process
         self.locals = []
+        self.obs_bufs = []
         for env in self.envs[1:]:
             local, remote = Pipe()
             self.locals.append(local)
-            p = Process(target=worker, args=(remote, env))
+            shared_obs = None
+            if shared_memory:
+                shared_obs = make_shared_obs(self.observation_space)
+            self.obs_bufs.append(as_array(shared_obs))
+            p = Process(target=worker, args=(remote, env, shared_obs))
             # Activate a remote worker as a daemon = True
             p.start()
             remote.close()
 
+    def _unpack(self, obs, obs_buf):
+        # Copy since the buffer is overwritten by the next step
+        if obs is None:
+            return obs_buf.copy()
+        return obs
+
     def reset(self):
         for local in self.locals:
             local.send(('reset', None))
-        results = [self.envs[0].reset()] + [local.recv() for local in self.locals]
+        results = [self.envs[0].reset()]
+        for local, obs_buf in zip(self.locals, self.obs_bufs):
+            results.append(self._unpack(local.recv(), obs_buf))
         return results
 
     def step(self, actions):
@@ -76,9 +138,12 @@ class ParallelEnv(gym.Env):
         obs, reward, done, info = self.envs[0].step(actions[0])
         if done:
             obs = self.envs[0].reset()
+        results = [(obs, reward, done, info)]
+        for local, obs_buf in zip(self.locals, self.obs_bufs):
+            obs, reward, done, info = local.recv()
+            results.append((self._unpack(obs, obs_buf), reward, done, info))
         # results = [(obs_1, obs_2, .., obs_n), ..., (info_1, info2, ..., info_n)]
-        results = zip(*[(obs, reward, done, info)] + [local.recv() for local in self.locals])
-        return results
+        return zip(*results)
 
     def close(self):
         for local in self.locals:
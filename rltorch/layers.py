@@ -18,7 +18,9 @@ class ACModel(nn.Module):
     def forward(self, x):
         x = self.share_model(x)
         action = self.actor_model(x)
-        value = self.value_model(x)
+        # Reduce the value head output to shape (batch_size,)
+        value = self.value_model(x).sum(-1)
         if self.action_dist is not None:
-            action = self.action_dist(action)
+            # Argument validation checks values on host, syncing every step
+            action = self.action_dist(action, validate_args=False)
         return action, value
@@ -5,6 +5,7 @@ from six.moves import xrange
 import itertools
 
 import numpy as np
+import torch
 
 # This is to be understood as a transition: Given `state0`, performing `action`
 # yields `reward` and results in `state1`, which might be `terminal`.
@@ -12,7 +13,7 @@ Experience = namedtuple('Experience',
                         'state0, action, reward, state1, terminal1')
 
 ACExperience = namedtuple('ACExperience',
-                          'action, reward, terminal, value, log_prob, entropy')
+                          'action, reward, terminal, state, value, log_prob')
 
 
 def sample_batch_indexes(low, high, size):
@@ -317,11 +318,35 @@ class SequentialMemory(Memory):
 
 
 class ACMemory(SequentialMemory):
+    """Memory for on-policy actor critic agents
+
+    Experiences are stored as struct of arrays: actions, rewards and
+    terminals in arrays of shape (limit, n_workers, ...), states, values
+    and log probabilities in tensors of the same layout on the model's
+    device. Sampling returns views of them without copy.
+
+    Parameters
+    ----------
+    num_frames_per_proc: int
+        The number of steps to sample from each worker
+    window_length: int
+        The length to be used for input
+    """
     def __init__(self, num_frames_per_proc, window_length, **kwargs):
         limit = num_frames_per_proc + window_length - 1
         super(ACMemory, self).__init__(limit, window_length=window_length, **kwargs)
         self.limit = limit
         self.num_frames_per_proc = num_frames_per_proc
+        # Allocated at the first append or store when the number of
+        # workers is known
+        self.actions = None
+        self.rewards = None
+        self.terminals = None
+        self.values = None
+        self.log_probs = None
+        self.states = None
+        # Only recent observations are kept to make states
+        self.observations = None
         self.reset()
 
     def get_recent_state(self, current_observation):
@@ -362,28 +387,113 @@ class ACMemory(SequentialMemory):
         state = np.concatenate(state, 0)
         return state
 
-    def store_value_log_prob(self, value, log_prob, entropy):
-        self.values.append(value)
-        self.log_probs.append(log_prob)
-        self.entropies.append(entropy)
+    def _allocate(self, action, reward, terminal):
+        action = np.asarray(action)
+        self.actions = np.empty((self.limit,) + action.shape,
+                                dtype=action.dtype)
+        self.rewards = np.empty((self.limit,) + np.shape(reward),
+                                dtype=np.float32)
+        self.terminals = np.empty((self.limit,) + np.shape(terminal),
+                                  dtype=np.bool_)
+
+    def append(self, observation, action, reward, terminal, training=True):
+        """Append an observation to the memory
+
+        Parameters
+        ----------
+        observation: array-like
+            Observations of workers
+        action: array-like
+            Actions of workers taken to obtain observation
+        reward: array-like
+            Rewards of workers obtained by taking action
+        terminal: array-like
+            Whether the next states of workers are terminal or not
+        """
+        # Only recent observations are kept to make states
+        super(SequentialMemory, self).append(observation, action, reward,
+                                             terminal, training=training)
+        if training:
+            if self.rewards is None:
+                self._allocate(action, reward, terminal)
+            elif self.nb_entries == len(self.rewards):
+                # Only happens if the memory is not reset after reaching limit
+                self.actions = np.concatenate([self.actions, self.actions])
+                self.rewards = np.concatenate([self.rewards, self.rewards])
+                self.terminals = np.concatenate([self.terminals,
+                                                 self.terminals])
+            t = self.nb_entries
+            self.actions[t] = action
+            self.rewards[t] = reward
+            self.terminals[t] = terminal
+            self._nb_entries += 1
+
+    @property
+    def nb_entries(self):
+        """Return number of stored steps
+
+        Returns
+        -------
+        The number of stored steps
+        """
+        return self._nb_entries
+
+    @property
+    def nb_states(self):
+        """Return number of usable states
+
+        Returns
+        -------
+        The number of usable states
+        """
+        return self._nb_entries - self.window_length + 1
+
+    def store_value_log_prob(self, value, log_prob, state):
+        """Store value, log probability and input state of the step in place
+
+        They are written into tensors of shape (limit, n_workers, ...) on
+        the device of the model so that sampling needs no stacking. The
+        state is kept so that the update can evaluate the current policy
+        on the rollout again.
+        """
+        if self.values is None:
+            self.values = torch.empty((self.limit, len(value)),
+                                      dtype=torch.float, device=value.device)
+            self.log_probs = torch.empty((self.limit,) + tuple(log_prob.shape),
+                                         dtype=torch.float,
+                                         device=log_prob.device)
+            self.states = torch.empty((self.limit,) + tuple(state.shape),
+                                      dtype=state.dtype, device=state.device)
+        elif self.nb_values == len(self.values):
+            # Only happens if the memory is not reset after reaching limit
+            self.values = torch.cat([self.values, self.values])
+            self.log_probs = torch.cat([self.log_probs, self.log_probs])
+            self.states = torch.cat([self.states, self.states])
+        t = self.nb_values
+        self.values[t] = value
+        self.log_probs[t] = log_prob
+        self.states[t] = state
+        self.nb_values += 1
 
     def sample(self):
-        return ACExperience(action=self.actions[-self.num_frames_per_proc:],
-                            reward=self.rewards[-self.num_frames_per_proc:],
-                            terminal=self.terminals[-self.num_frames_per_proc:],
-                            value=self.values[-self.num_frames_per_proc:],
-                            log_prob=self.log_probs[-self.num_frames_per_proc:],
-                            entropy=self.entropies[-self.num_frames_per_proc:])
+        t_st = self.nb_values - self.num_frames_per_proc
+        state = self.states[t_st:self.nb_values]
+        value = self.values[t_st:self.nb_values]
+        log_prob = self.log_probs[t_st:self.nb_values]
+        t_st = self.nb_entries - self.num_frames_per_proc
+        return ACExperience(action=self.actions[t_st:self.nb_entries],
+                            reward=self.rewards[t_st:self.nb_entries],
+                            terminal=self.terminals[t_st:self.nb_entries],
+                            state=state,
+                            value=value,
+                            log_prob=log_prob)
 
 
     def reset(self):
-        self.actions = list()
-        self.rewards = list()
-        self.terminals = list()
-        self.observations = list()
-        self.values = list()
-        self.log_probs = list()
-        self.entropies = list()
+        # Arrays and tensors are reused; the next rollout overwrites them
+        # from the start
+        self._nb_entries = 0
+        self.nb_values = 0
 
     def get_config(self):
         """Return configurations of ACMemory
@@ -16,4 +16,13 @@ class AtariProcessor(BaseProcessor):
             observation = np.maximum(observation, self.last_observation)
         observation = np.uint8(resize(rgb2gray(observation),
                                       (self.frame_width, self.frame_height)))
-        return observation.reshape((1, self.frame_width, self.frame_height))
\ No newline at end of file
+        return observation.reshape((1, self.frame_width, self.frame_height))
+
+    def process_batch(self, observations):
+        if self.last_observation is not None:
+            observations = np.maximum(observations, self.last_observation)
+        n_obs = len(observations)
+        # Batch axis is kept at its size, so workers do not mix when resizing
+        observations = np.uint8(resize(rgb2gray(observations),
+                                       (n_obs, self.frame_width, self.frame_height)))
+        return observations.reshape((n_obs, 1, self.frame_width, self.frame_height))
\ No newline at end of file
@@ -1,7 +1,23 @@
 from abc import ABC, abstractmethod
 
+import numpy as np
+
 
 class BaseProcessor(ABC):
     @abstractmethod
     def process(self, observation):
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+
+    def process_batch(self, observations):
+        """Process observations of all workers at once
+
+        Parameters
+        ----------
+        observations: np.ndarray
+            Observations stacked along the first axis, one row per worker
+
+        Returns
+        -------
+        np.ndarray of processed observations stacked along the first axis
+        """
+        return np.stack([self.process(obs) for obs in observations])
\ No newline at end of file
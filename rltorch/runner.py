@@ -66,4 +66,6 @@ class Runner(object):
                     self.env.render(render_all)
                 else:
                     self.env.render()
+        if hasattr(self.agent, 'flush_log'):
+            self.agent.flush_log()
         return self.agent